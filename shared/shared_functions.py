@@ -2,7 +2,11 @@ import chromadb
 from chromadb.utils import embedding_functions
 import json
 import re
+import threading
+import time
+import zlib
 import numpy as np
+from pathlib import Path
 from typing import List, Dict, Any, Optional
 
 # Initialize ChromaDB client
@@ -58,8 +62,66 @@ def load_json_data(file_path: str) -> List[Dict]:
         print(f"Error loading json data: {e}")
         return []
 
-def create_similarity_search_collection(collection_name: str, collection_metadata: dict = None):
-    """Create ChromaDB collection with sentence transformer embeddings"""
+RAG_CONFIG_PATH = Path(__file__).parent.parent / 'config' / 'ragSystem.ini'
+
+# Keys in config/ragSystem.ini mapped to ChromaDB HNSW configuration fields
+HNSW_CONFIG_KEYS = {
+    'hnswMaxNeighbors': 'max_neighbors',
+    'hnswEfConstruction': 'ef_construction',
+    'hnswEfSearch': 'ef_search'
+}
+
+def read_config(file_path):
+    """Read 'key value' lines from a config file"""
+    config = {}
+    with open(file_path, 'r') as file:
+        for line in file:
+            if line.strip() and not line.startswith('#'):
+                key, value = line.split(' ', 1)
+                config[key] = value.strip()
+    return config
+
+def write_config(file_path, updates):
+    """Update or append config keys, keeping the other lines untouched"""
+    with open(file_path, 'r') as file:
+        lines = file.read().splitlines()
+
+    pending = dict(updates)
+    for i, line in enumerate(lines):
+        if line.strip() and not line.startswith('#'):
+            key = line.split(' ', 1)[0]
+            if key in pending:
+                lines[i] = f"{key} {pending.pop(key)}"
+
+    lines.extend(f"{key} {value}" for key, value in pending.items())
+
+    with open(file_path, 'w') as file:
+        file.write("\n".join(lines) + "\n")
+
+def get_embedding_function():
+    """Create the sentence transformer embedding function used by all collections"""
+    return embedding_functions.SentenceTransformerEmbeddingFunction(
+        model_name="all-MiniLM-L6-v2"
+    )
+
+def get_hnsw_config(config_path=RAG_CONFIG_PATH) -> Dict[str, int]:
+    """Read tuned HNSW parameters from ragSystem.ini, if any were written"""
+    try:
+        config = read_config(config_path)
+        return {field: int(config[key]) for key, field in HNSW_CONFIG_KEYS.items() if key in config}
+    except Exception as e:
+        print(f"Error reading HNSW config from {config_path}: {e}")
+        return {}
+
+def create_similarity_search_collection(collection_name: str, collection_metadata: dict = None,
+                                        hnsw_config: dict = None):
+    """Create ChromaDB collection with sentence transformer embeddings
+
+    HNSW parameters ('max_neighbors' (M), 'ef_construction', 'ef_search')
+    are read from config/ragSystem.ini as written by src/tune_hnsw.py;
+    entries in hnsw_config override them and unset parameters keep
+    ChromaDB's defaults.
+    """
     try:
         # Try to delete existing collection to start fresh
         chroma_client.delete_collection(collection_name)
@@ -67,16 +129,19 @@ def create_similarity_search_collection(collection_name: str, collection_metadat
         pass
     
     # Create embedding function
-    sentence_transformer_ef = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
+    sentence_transformer_ef = get_embedding_function()
+    
+    hnsw = {"space": "cosine"}
+    hnsw.update(get_hnsw_config())
+    if hnsw_config:
+        hnsw.update(hnsw_config)
     
     # Create new collection
     return chroma_client.create_collection(
         name=collection_name,
         metadata=collection_metadata,
         configuration={
-            "hnsw": {"space": "cosine"},
+            "hnsw": hnsw,
             "embedding_function": sentence_transformer_ef
         }
     )
@@ -89,87 +154,348 @@ def get_similarity_search_collection(collection_name: str):
         print(f"Error retrieving collection {collection_name}: {e}")
         return None
 
-def populate_similarity_collection(collection, data_items: List[Dict]):
-    """Populate collection with data and generate embeddings"""
-    documents = []
-    metadatas = []
+class Deadline:
+    """End-to-end latency budget shared by the stages of a request"""
+    __slots__ = ('budget', 'expires_at')
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        """Seconds left before the deadline, never negative"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def elapsed(self) -> float:
+        """Seconds spent since the budget started"""
+        return self.budget - (self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        """Whether the budget has been used up"""
+        return time.monotonic() >= self.expires_at
+
+def run_with_deadline(fn, deadline: Optional[Deadline], *args, **kwargs):
+    """Call fn in a worker thread and wait for it at most until the deadline
+
+    Raises TimeoutError when the deadline passes first; the worker is a daemon
+    thread and is abandoned. Without a deadline fn is called directly.
+    """
+    if deadline is None:
+        return fn(*args, **kwargs)
+
+    outcome = {}
+
+    def target():
+        try:
+            outcome['result'] = fn(*args, **kwargs)
+        except BaseException as e:
+            outcome['error'] = e
+
+    worker = threading.Thread(target=target, daemon=True)
+    worker.start()
+    worker.join(deadline.remaining())
+
+    if worker.is_alive():
+        raise TimeoutError(f"latency budget of {deadline.budget:.1f}s exceeded")
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+# MinHash/LSH parameters for near-duplicate detection at ingestion
+MINHASH_NUM_PERM = 128
+MINHASH_BANDS = 32
+MINHASH_SHINGLE_SIZE = 5
+MINHASH_SEED = 42
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# Prefix of the metadata keys recording sections of dropped near-duplicates
+SECTION_ALIAS_PREFIX = "alias_section:"
+
+_rng = np.random.RandomState(MINHASH_SEED)
+_MINHASH_A = _rng.randint(1, _MAX_HASH, size=MINHASH_NUM_PERM, dtype=np.uint64)
+_MINHASH_B = _rng.randint(0, _MAX_HASH, size=MINHASH_NUM_PERM, dtype=np.uint64)
+del _rng
+
+def build_document_text(data: Dict) -> str:
+    """Build the text that gets embedded for a data item"""
+    text = f"{data['section']}: "
+    text += f"{data.get('content', '')}. "
+    return text
+
+def section_alias_key(section: str) -> str:
+    """Metadata key marking a kept passage as also covering another section
+
+    ChromaDB metadata values must be scalars, so each section of a dropped
+    near-duplicate is recorded as its own boolean key on the kept passage.
+    """
+    return f"{SECTION_ALIAS_PREFIX}{section}"
+
+def compute_minhash_signature(text: str) -> np.ndarray:
+    """Compute a MinHash signature over the character shingles of a text"""
+    normalized = re.sub(r'\s+', ' ', text.lower()).strip()
+    if len(normalized) <= MINHASH_SHINGLE_SIZE:
+        shingles = {normalized}
+    else:
+        shingles = {normalized[i:i + MINHASH_SHINGLE_SIZE]
+                    for i in range(len(normalized) - MINHASH_SHINGLE_SIZE + 1)}
+
+    # crc32 is stable across runs, unlike the salted built-in hash()
+    hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles),
+                         dtype=np.uint64, count=len(shingles))
+    permuted = (np.outer(hashes, _MINHASH_A) + _MINHASH_B) % _MERSENNE_PRIME
+    return (permuted & _MAX_HASH).min(axis=0)
+
+def find_near_duplicates(texts: List[str], threshold: float = 0.85) -> Dict[int, int]:
+    """Find near-duplicate texts using MinHash signatures and LSH banding
+
+    Returns a mapping from the index of each duplicate text to the index of
+    the earlier text it duplicates.
+    """
+    rows = MINHASH_NUM_PERM // MINHASH_BANDS
+    signatures = [compute_minhash_signature(text) for text in texts]
+    buckets = [{} for _ in range(MINHASH_BANDS)]
+    duplicates = {}
+
+    for i, signature in enumerate(signatures):
+        candidates = set()
+        band_keys = []
+        for band in range(MINHASH_BANDS):
+            key = signature[band * rows:(band + 1) * rows].tobytes()
+            band_keys.append(key)
+            candidates.update(buckets[band].get(key, ()))
+
+        # Compare against the earliest matching canonical passage
+        for j in sorted(candidates):
+            if np.mean(signatures[j] == signature) >= threshold:
+                duplicates[i] = j
+                break
+
+        # Only canonical passages are indexed, so duplicates link to the original
+        if i not in duplicates:
+            for band, key in enumerate(band_keys):
+                buckets[band].setdefault(key, []).append(i)
+
+    return duplicates
+
+def assign_unique_ids(data_items: List[Dict]) -> List[str]:
+    """Assign deterministic, collision-free IDs to data items
+
+    The first item with a given doc_id keeps it; later items get a '#<n>'
+    suffix, which cannot clash with the '_'-joined IDs from load_json_data.
+    """
+    base_ids = [str(data.get('doc_id', i)) for i, data in enumerate(data_items)]
+    reserved = set(base_ids)
+    occurrences = {}
     ids = []
-    
-    # Create unique IDs to avoid duplicates
-    used_ids = set()
-    
-    for i, data in enumerate(data_items):
-        if data.get("content", '') == '':
+
+    for base_id in base_ids:
+        count = occurrences.get(base_id, 0)
+        occurrences[base_id] = count + 1
+        if count == 0:
+            ids.append(base_id)
             continue
-        
-        # Create comprehensive text for embedding using rich JSON structure
-        text = f"{data['section']}: "
-        text += f"{data.get('content', '')}. "
-        
-        # Generate unique ID to avoid duplicates
-        base_id = str(data.get('doc_id', i))
-        unique_id = base_id
-        counter = 1
-        while unique_id in used_ids:
-            unique_id = f"{base_id}_{counter}"
-            counter += 1
-        used_ids.add(unique_id)
-        
-        documents.append(text)
+
+        unique_id = f"{base_id}#{count}"
+        while unique_id in reserved:
+            count += 1
+            unique_id = f"{base_id}#{count}"
+        occurrences[base_id] = count + 1
+        reserved.add(unique_id)
         ids.append(unique_id)
-        metadatas.append({
-            "section": data["section"]
-        })
+
+    return ids
+
+def populate_similarity_collection(collection, data_items: List[Dict],
+                                   dedup_threshold: Optional[float] = 0.85,
+                                   link_duplicates: bool = True):
+    """Populate collection with data and generate embeddings
+
+    Near-duplicate passages (estimated Jaccard similarity >= dedup_threshold)
+    are not embedded. The sections of dropped passages are recorded on the
+    passage they repeat (see section_alias_key), so section-filtered searches
+    still find them. With link_duplicates, the IDs of the dropped passages
+    are also recorded in its 'duplicate_ids' metadata. Pass
+    dedup_threshold=None to embed every passage.
+    """
+    items = [data for data in data_items if data.get("content", '') != '']
+    ids = assign_unique_ids(items)
+    documents = [build_document_text(data) for data in items]
+    metadatas = [{"section": data["section"]} for data in items]
+
+    duplicates = {}
+    if dedup_threshold is not None:
+        duplicates = find_near_duplicates(documents, dedup_threshold)
+
+    for duplicate, original in duplicates.items():
+        section = items[duplicate]["section"]
+        if section != metadatas[original]["section"]:
+            metadatas[original][section_alias_key(section)] = True
+
+        if link_duplicates:
+            linked = metadatas[original].get("duplicate_ids")
+            metadatas[original]["duplicate_ids"] = f"{linked},{ids[duplicate]}" if linked else ids[duplicate]
+
+    keep = [i for i in range(len(items)) if i not in duplicates]
     
     # Add all data to collection
     collection.add(
-        documents=documents,
-        metadatas=metadatas,
-        ids=ids
+        documents=[documents[i] for i in keep],
+        metadatas=[metadatas[i] for i in keep],
+        ids=[ids[i] for i in keep]
     )
     
-    print(f"Added {len(documents)} items to collection")
+    print(f"Added {len(keep)} items to collection ({len(duplicates)} near-duplicates skipped)")
+
+class SearchResults:
+    """Column-oriented view over a ChromaDB query response for a single query.
+
+    The raw id/document/metadata rows are kept as returned by ChromaDB and
+    distances are held in a NumPy array, so no per-hit dict is built unless a
+    caller indexes or iterates the results.
+    """
+    __slots__ = ('ids', 'distances', '_documents', '_metadatas')
+
+    def __init__(self, ids: List[str], distances: np.ndarray,
+                 documents: List[str], metadatas: List[Dict]):
+        self.ids = ids
+        self.distances = distances
+        self._documents = documents
+        self._metadatas = metadatas
+
+    @classmethod
+    def empty(cls) -> 'SearchResults':
+        """Return a result set without any hits"""
+        return cls([], np.empty(0, dtype=np.float64), [], [])
+
+    @classmethod
+    def from_query_response(cls, response: Dict, query_index: int = 0) -> 'SearchResults':
+        """Wrap the rows of one query in a ChromaDB query response"""
+        if not response or not response.get('ids') or query_index >= len(response['ids']):
+            return cls.empty()
+
+        ids = response['ids'][query_index]
+        if len(ids) == 0:
+            return cls.empty()
+
+        return cls(
+            ids,
+            np.asarray(response['distances'][query_index], dtype=np.float64),
+            response['documents'][query_index],
+            response['metadatas'][query_index]
+        )
+
+    @classmethod
+    def from_batch_response(cls, response: Dict, num_queries: int) -> List['SearchResults']:
+        """Wrap every query of a batched ChromaDB query response
+
+        Always returns one result set per query; a response that cannot be
+        split per query yields empty result sets.
+        """
+        if not response or not response.get('ids') or len(response['ids']) != num_queries:
+            return [cls.empty() for _ in range(num_queries)]
+        return [cls.from_query_response(response, i) for i in range(num_queries)]
+
+    @property
+    def similarity_scores(self) -> np.ndarray:
+        """Similarity scores (1 - distance) for all hits
+
+        A new array is computed on every access, so bind it once rather than
+        indexing the property inside a loop.
+        """
+        return 1 - self.distances
+
+    def document(self, i: int) -> str:
+        """Content of the i-th hit"""
+        return self._documents[i]
+
+    def section(self, i: int) -> str:
+        """Section name of the i-th hit"""
+        return self._metadatas[i]['section']
 
-def perform_similarity_search(collection, query: str, n_results: int = 5) -> List[Dict]:
-    """Perform similarity search and return formatted results"""
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SearchResults(
+                self.ids[index],
+                self.distances[index],
+                self._documents[index],
+                self._metadatas[index]
+            )
+
+        distance = float(self.distances[index])
+        return {
+            'doc_id': self.ids[index],
+            'section': self._metadatas[index]['section'],
+            'content': self._documents[index],
+            'similarity_score': 1 - distance,
+            'distance': distance
+        }
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield self[i]
+
+    def __repr__(self) -> str:
+        return f"SearchResults(n={len(self)}, ids={self.ids!r})"
+
+def perform_similarity_search(collection, query: str, n_results: int = 5,
+                              deadline: Optional[Deadline] = None) -> SearchResults:
+    """Perform similarity search and return formatted results
+
+    With a deadline, the search gives up and returns no results once the
+    latency budget is used up.
+    """
     try:
-        results = collection.query(
+        results = run_with_deadline(
+            collection.query,
+            deadline,
             query_texts=[query],
             n_results=n_results
         )
         
-        if not results or not results['ids'] or len(results['ids'][0]) == 0:
-            return []
-        
-        formatted_results = []
-        for i in range(len(results['ids'][0])):
-            # Calculate similarity score (1 - distance)
-            similarity_score = 1 - results['distances'][0][i]
-            
-            result = {
-                'doc_id': results['ids'][0][i],
-                'section': results['metadatas'][0][i]['section'],
-                'content': results['documents'][0][i],
-                'similarity_score': similarity_score,
-                'distance': results['distances'][0][i]
-            }
-            formatted_results.append(result)
-        
-        return formatted_results
+        return SearchResults.from_query_response(results)
         
+    except TimeoutError as e:
+        print(f"Similarity search timed out: {e}")
+        return SearchResults.empty()
     except Exception as e:
         print(f"Error in similarity search: {e}")
+        return SearchResults.empty()
+
+def perform_batch_similarity_search(collection, queries: List[str],
+                                    n_results: int = 5) -> List[SearchResults]:
+    """Perform similarity search for several queries in a single request"""
+    if not queries:
         return []
 
+    try:
+        results = collection.query(
+            query_texts=queries,
+            n_results=n_results
+        )
+        
+        return SearchResults.from_batch_response(results, len(queries))
+        
+    except Exception as e:
+        print(f"Error in batch similarity search: {e}")
+        return [SearchResults.empty() for _ in queries]
+
 def perform_filtered_similarity_search(collection, query: str, section_filter: str = None, 
-                                     n_results: int = 5) -> List[Dict]:
+                                     n_results: int = 5) -> SearchResults:
     """Perform filtered similarity search with metadata constraints"""
     where_clause = None
     
     # Build filters list
     filters = []
     if section_filter:
-        filters.append({"section": section_filter})
+        # Also match passages standing in for a deduplicated passage of this section
+        filters.append({"$or": [
+            {"section": section_filter},
+            {section_alias_key(section_filter): True}
+        ]})
     
     # Construct where clause based on number of filters
     if len(filters) == 1:
@@ -184,27 +510,11 @@ def perform_filtered_similarity_search(collection, query: str, section_filter: s
             where=where_clause
         )
         
-        if not results or not results['ids'] or len(results['ids'][0]) == 0:
-            return []
-        
-        formatted_results = []
-        for i in range(len(results['ids'][0])):
-            similarity_score = 1 - results['distances'][0][i]
-            
-            result = {
-                'doc_id': results['ids'][0][i],
-                'section': results['metadatas'][0][i]['section'],
-                'content': results['documents'][0][i],
-                'similarity_score': similarity_score,
-                'distance': results['distances'][0][i]
-            }
-            formatted_results.append(result)
-        
-        return formatted_results
+        return SearchResults.from_query_response(results)
         
     except Exception as e:
         print(f"Error in filtered search: {e}")
-        return []
+        return SearchResults.empty()
 
 def clear_collection(collection):
     """Clear all items from the collection"""
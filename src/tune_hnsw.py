@@ -0,0 +1,153 @@
+import sys
+import time
+import itertools
+from pathlib import Path
+
+parent_dir = Path(__file__).parent.parent
+
+sys.path.append(str(parent_dir))
+
+from shared.shared_functions import *
+
+TUNING_COLLECTION = "hnsw_tuning"
+
+# Latency measurement: untimed warm-up queries, then timed repeats of every query
+WARMUP_QUERIES = 10
+QUERY_REPEATS = 5
+
+# Grid of HNSW settings to evaluate
+MAX_NEIGHBORS_GRID = [8, 16, 32]
+EF_CONSTRUCTION_GRID = [64, 100, 200]
+EF_SEARCH_GRID = [10, 50, 100, 200]
+
+def main():
+    """Tune HNSW parameters for a recall/latency target and store them in the config"""
+    force = '--force' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--force']
+    k = int(args[0]) if len(args) > 0 else 5
+    target_recall = float(args[1]) if len(args) > 1 else 0.95
+    query_file = args[2] if len(args) > 2 else None
+
+    try:
+        config = read_config(RAG_CONFIG_PATH)
+        data_items = load_json_data(config['dataFilePath'])
+        queries = load_queries(query_file, data_items)
+        print(f"Tuning with {len(queries)} queries, recall@{k} target {target_recall:.2f}")
+
+        results = tune_hnsw_parameters(data_items, queries, k)
+        best = select_best_configuration(results, target_recall)
+
+        if best is None:
+            print("❌ No configuration could be evaluated")
+            return
+
+        print(f"Best: M={best['max_neighbors']}, ef_construction={best['ef_construction']}, "
+              f"ef_search={best['ef_search']} | recall@{k} {best['recall']:.3f} | "
+              f"p50 {best['p50_ms']:.2f} ms, p95 {best['p95_ms']:.2f} ms")
+
+        if best['recall'] < target_recall:
+            if not force:
+                print(f"❌ No configuration reached recall@{k} {target_recall:.2f}; "
+                      f"{RAG_CONFIG_PATH} left unchanged (use --force to write the highest recall)")
+                return
+            print(f"⚠️  No configuration reached the target, writing the highest recall (--force)")
+
+        write_config(RAG_CONFIG_PATH, {
+            'hnswMaxNeighbors': best['max_neighbors'],
+            'hnswEfConstruction': best['ef_construction'],
+            'hnswEfSearch': best['ef_search']
+        })
+        print(f"✅ Saved HNSW configuration to {RAG_CONFIG_PATH}")
+
+    except Exception as error:
+        print(f"❌ Error tuning HNSW parameters: {error}")
+    finally:
+        delete_collection(TUNING_COLLECTION)
+
+def load_queries(query_file, data_items):
+    """Load one query per line, defaulting to the section titles of the data"""
+    if query_file:
+        with open(query_file, 'r', encoding='utf-8') as file:
+            return [line.strip() for line in file if line.strip()]
+
+    return list(dict.fromkeys(data['section'] for data in data_items if data.get('section')))
+
+def exact_top_k(document_embeddings, query_embeddings, k):
+    """Brute-force cosine nearest neighbours used as recall ground truth"""
+    documents = document_embeddings / np.linalg.norm(document_embeddings, axis=1, keepdims=True)
+    queries = query_embeddings / np.linalg.norm(query_embeddings, axis=1, keepdims=True)
+    similarities = queries @ documents.T
+    k = min(k, documents.shape[0])
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    return [set(row) for row in top]
+
+def tune_hnsw_parameters(data_items, queries, k):
+    """Build the collection for every grid setting and measure recall@k and latency"""
+    query_embeddings = np.asarray(get_embedding_function()(queries), dtype=np.float32)
+    query_lists = [query_embedding.tolist() for query_embedding in query_embeddings]
+    results = []
+    stored = None
+    ground_truth = None
+
+    # ef_search only affects queries, so each build is reused across the ef_search grid
+    for max_neighbors, ef_construction in itertools.product(MAX_NEIGHBORS_GRID, EF_CONSTRUCTION_GRID):
+        for ef_search in EF_SEARCH_GRID:
+            hnsw_config = {
+                'max_neighbors': max_neighbors,
+                'ef_construction': ef_construction,
+                'ef_search': ef_search
+            }
+            if ef_search == EF_SEARCH_GRID[0]:
+                collection = create_similarity_search_collection(TUNING_COLLECTION, hnsw_config=hnsw_config)
+                if stored is None:
+                    # Embed the corpus once; later builds reuse the stored embeddings
+                    populate_similarity_collection(collection, data_items)
+                    stored = collection.get(include=['embeddings', 'documents', 'metadatas'])
+                    ids = np.asarray(stored['ids'])
+                    exact = exact_top_k(np.asarray(stored['embeddings'], dtype=np.float32), query_embeddings, k)
+                    ground_truth = [set(ids[list(row)]) for row in exact]
+                else:
+                    collection.add(
+                        ids=stored['ids'],
+                        embeddings=stored['embeddings'],
+                        documents=stored['documents'],
+                        metadatas=stored['metadatas']
+                    )
+            else:
+                collection.modify(configuration={'hnsw': {'ef_search': ef_search}})
+
+            for i in range(WARMUP_QUERIES):
+                collection.query(query_embeddings=[query_lists[i % len(query_lists)]], n_results=k)
+
+            latencies = []
+            hits = 0
+            for query_list, expected in zip(query_lists, ground_truth):
+                for _ in range(QUERY_REPEATS):
+                    start = time.perf_counter()
+                    response = collection.query(query_embeddings=[query_list], n_results=k)
+                    latencies.append(time.perf_counter() - start)
+                hits += len(expected.intersection(response['ids'][0]))
+
+            result = dict(hnsw_config)
+            result['recall'] = hits / sum(len(expected) for expected in ground_truth)
+            result['p50_ms'] = float(np.percentile(latencies, 50)) * 1000
+            result['p95_ms'] = float(np.percentile(latencies, 95)) * 1000
+            results.append(result)
+            print(f"M={max_neighbors:<3} ef_construction={ef_construction:<4} ef_search={ef_search:<4} "
+                  f"recall@{k} {result['recall']:.3f} | p50 {result['p50_ms']:.2f} ms, "
+                  f"p95 {result['p95_ms']:.2f} ms")
+
+    return results
+
+def select_best_configuration(results, target_recall):
+    """Pick the lowest median latency configuration meeting the recall target, else the most accurate"""
+    if not results:
+        return None
+
+    satisfying = [result for result in results if result['recall'] >= target_recall]
+    if satisfying:
+        return min(satisfying, key=lambda result: (result['p50_ms'], result['p95_ms']))
+    return max(results, key=lambda result: (result['recall'], -result['p50_ms']))
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,10 @@ parent_dir = Path(__file__).parent.parent
 sys.path.append(str(parent_dir))
 
 from shared.shared_functions import *
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import openai
+import httpx
+import threading
 
 
 client = openai.OpenAI(
@@ -15,6 +17,26 @@ client = openai.OpenAI(
     api_key = "sk-no-key-required"
 )
 
+# End-to-end latency budget per query, in seconds; fits a full MAX_TOKENS
+# generation plus GENERATION_OVERHEAD with several seconds left for retrieval
+DEFAULT_LATENCY_BUDGET = 30.0
+MAX_TOKENS = 512
+# Below this many tokens a generation is not worth starting
+MIN_TOKENS = 32
+# Rough generation speed of the local llama.cpp server, used to size max_tokens
+ESTIMATED_TOKENS_PER_SECOND = 25.0
+# Seconds reserved for prompt processing and time to first token
+GENERATION_OVERHEAD = 3.0
+
+# Counts of responses degraded to meet their latency budget
+degradation_stats = {
+    'total': 0,
+    'retrieval_timeout': 0,
+    'reduced_tokens': 0,
+    'partial': 0,
+    'fallback': 0
+}
+
 def main():
     """Main function for enhanced RAG chatbot system"""
     try:
@@ -31,7 +53,7 @@ def main():
     except Exception as error:
         print(f"❌ Error: {error}")
 
-def prepare_context_for_llm(query: str, search_results: List[Dict]) -> str:
+def prepare_context_for_llm(query: str, search_results: SearchResults) -> str:
     """Prepare structured context from search results for LLM"""
     if not search_results:
         return "No relevant document found in the database."
@@ -52,8 +74,29 @@ def prepare_context_for_llm(query: str, search_results: List[Dict]) -> str:
     
     return "\n".join(context_parts)
 
-def generate_llm_rag_response(query: str, search_results: List[Dict], conversation_history: List[str]) -> str:
-    """Generate response using llama.cpp with retrieved context"""
+def generate_llm_rag_response(query: str, search_results: SearchResults, conversation_history: List[str],
+                              deadline: Optional[Deadline] = None) -> str:
+    """Generate response using llama.cpp with retrieved context
+
+    Generation is bounded by the remaining latency budget: max_tokens is
+    reduced to what fits in the time left, and when the deadline passes the
+    text streamed so far (or the extractive fallback) is returned. The
+    deadline is enforced on wall-clock time, whether or not chunks arrive.
+    """
+    if deadline is None:
+        deadline = Deadline(DEFAULT_LATENCY_BUDGET)
+    degradation_stats['total'] += 1
+
+    max_tokens = tokens_within(deadline.remaining())
+    if max_tokens < MIN_TOKENS:
+        print("⏱️  Latency budget exhausted by retrieval, using extractive response")
+        return partial_or_fallback_response(query, search_results, [])
+    # Only count queries where time already spent cost token headroom
+    if max_tokens < tokens_within(deadline.budget):
+        degradation_stats['reduced_tokens'] += 1
+
+    chunks = []
+    stop = threading.Event()
     try:
         # Prepare context from search results
         context = prepare_context_for_llm(query, search_results)
@@ -76,48 +119,88 @@ Please provide a helpful, short response that:
 
 Response:'''
 
-        # Generate response using IBM Granite
-        generated_response = client.completions.create(
-            model="davinci-002",
-            prompt=prompt,
-            max_tokens=512
+        # No retries, so a timeout cannot restart the request with a fresh budget
+        budget_client = client.with_options(
+            max_retries=0,
+            timeout=httpx.Timeout(deadline.remaining())
         )
 
-        print(f'Generated Response: {type(generated_response)}')
-
-        # Extract the generated text
-        if len(generated_response.choices) > 0:
-            response_text = generated_response.choices[0].text
-
-            # Clean up the response if needed
-            response_text = response_text.strip()
-            
-            # If response is too short, provide a fallback
-            if len(response_text) < 50:
-                return generate_fallback_response(query, search_results)
-            
-            return response_text
-        else:
-            return generate_fallback_response(query, search_results)
+        # The worker owns the stream: it stops reading once the deadline has
+        # been signalled and always closes the connection itself, even when
+        # the main thread has already given up on it
+        def stream_response():
+            stream = budget_client.completions.create(
+                model="davinci-002",
+                prompt=prompt,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            try:
+                if stop.is_set():
+                    return
+                for chunk in stream:
+                    if chunk.choices:
+                        chunks.append(chunk.choices[0].text)
+                    if stop.is_set():
+                        break
+            finally:
+                stream.close()
+
+        # Stream the response so partial text is available at the deadline
+        run_with_deadline(stream_response, deadline)
+
+        # Clean up the response if needed
+        response_text = "".join(chunks).strip()
+        
+        # If response is too short, provide a fallback
+        if len(response_text) < 50:
+            return partial_or_fallback_response(query, search_results, chunks)
+        
+        return response_text
             
+    except (TimeoutError, openai.APITimeoutError, httpx.TimeoutException):
+        stop.set()
+        print("⏱️  Latency budget exceeded, returning partial response")
+        return partial_or_fallback_response(query, search_results, list(chunks))
     except Exception as e:
+        stop.set()
         print(f"❌ LLM Error: {e}")
+        return partial_or_fallback_response(query, search_results, list(chunks))
+
+def tokens_within(seconds: float) -> int:
+    """Number of tokens that can be generated in the given time, capped at MAX_TOKENS"""
+    return min(MAX_TOKENS, int((seconds - GENERATION_OVERHEAD) * ESTIMATED_TOKENS_PER_SECOND))
+
+def partial_or_fallback_response(query: str, search_results: SearchResults, chunks: List[str]) -> str:
+    """Return the partially streamed text if usable, else the extractive fallback
+
+    Every degraded exit of generate_llm_rag_response goes through here so
+    degradation_stats stays accurate.
+    """
+    response_text = "".join(chunks).strip()
+    if len(response_text) < 50:
+        degradation_stats['fallback'] += 1
         return generate_fallback_response(query, search_results)
 
-def generate_fallback_response(query: str, search_results: List[Dict]) -> str:
+    degradation_stats['partial'] += 1
+    return response_text + "..."
+
+def get_degradation_stats() -> Dict[str, int]:
+    """Return counts of responses degraded to meet the latency budget"""
+    return dict(degradation_stats)
+
+def generate_fallback_response(query: str, search_results: SearchResults) -> str:
     """Generate fallback response when LLM fails"""
     if not search_results:
         return "I couldn't find any documents matching your request. Try rephrasing your question!"
     
-    top_result = search_results[0]
     response_parts = []
     
-    response_parts.append(f"Based on your request for '{query}', I'd recommend {top_result['section']}.")
-    response_parts.append(f"Content: {top_result['content']}.")
+    response_parts.append(f"Based on your request for '{query}', I'd recommend {search_results.section(0)}.")
+    response_parts.append(f"Content: {search_results.document(0)}.")
     
     if len(search_results) > 1:
-        second_choice = search_results[1]
-        response_parts.append(f"Another great document would be {second_choice['section']}.")
+        response_parts.append(f"Another great document would be {search_results.section(1)}.")
     
     return " ".join(response_parts)
 
@@ -136,6 +219,7 @@ def rag_chatbot(collection):
     print("\nCommands:")
     print("  • 'help' - Show detailed help menu")
     print("  • 'compare' - Compare recommendations for two different queries")
+    print("  • 'stats' - Show latency budget degradation counts")
     print("  • 'quit' - Exit the chatbot")
     print("-" * 70)
     
@@ -160,6 +244,9 @@ def rag_chatbot(collection):
             elif user_input.lower() in ['compare']:
                 handle_enhanced_comparison_mode(collection)
             
+            elif user_input.lower() in ['stats']:
+                show_degradation_stats()
+            
             else:
                 # Process the food query with enhanced RAG
                 ai_response = handle_enhanced_rag_query(collection, user_input, conversation_history)
@@ -177,23 +264,31 @@ def rag_chatbot(collection):
         except Exception as e:
             print(f"❌ Bot: Sorry, I encountered an error: {e}")
 
-def handle_enhanced_rag_query(collection, query: str, conversation_history: List[str]):
+def handle_enhanced_rag_query(collection, query: str, conversation_history: List[str],
+                              latency_budget: float = DEFAULT_LATENCY_BUDGET):
     """Handle user query with enhanced RAG approach"""
+    deadline = Deadline(latency_budget)
     print(f"\n🔍 Searching vector database for: '{query}'...")
     
     # Perform similarity search with more results for better context
-    search_results = perform_similarity_search(collection, query, 3)
+    search_results = perform_similarity_search(collection, query, 3, deadline)
+    
+    if not search_results and deadline.expired():
+        degradation_stats['retrieval_timeout'] += 1
+        print("🤖 Bot: Sorry, searching the documents took too long.")
+        print("      Please try again!")
+        return
     
     if not search_results:
         print("🤖 Bot: I couldn't find any documents matching your request.")
         print("      Try rephrasing your question!")
         return
     
-    print(f"✅ Found {len(search_results)} relevant matches")
+    print(f"✅ Found {len(search_results)} relevant matches in {deadline.elapsed():.2f}s")
     print("🧠 Generating AI-powered response...")
     
-    # Generate enhanced RAG response using IBM Granite
-    ai_response = generate_llm_rag_response(query, search_results, conversation_history)
+    # Generate enhanced RAG response within what is left of the budget
+    ai_response = generate_llm_rag_response(query, search_results, conversation_history, deadline)
     
     print(f"\n🤖 Bot: {ai_response}")
     
@@ -223,9 +318,8 @@ def handle_enhanced_comparison_mode(collection):
     
     print(f"\n🔍 Analyzing '{query1}' vs '{query2}' with AI...")
     
-    # Get results for both queries
-    results1 = perform_similarity_search(collection, query1, 3)
-    results2 = perform_similarity_search(collection, query2, 3)
+    # Get results for both queries in a single batched request
+    results1, results2 = perform_batch_similarity_search(collection, [query1, query2], 3)
     
     # Generate AI-powered comparison
     comparison_response = generate_llm_comparison(query1, query2, results1, results2)
@@ -238,13 +332,15 @@ def handle_enhanced_comparison_mode(collection):
     print(f"{'Query 1: ' + query1[:20] + '...' if len(query1) > 20 else 'Query 1: ' + query1:<30} | {'Query 2: ' + query2[:20] + '...' if len(query2) > 20 else 'Query 2: ' + query2}")
     print("-" * 60)
     
+    scores1 = results1.similarity_scores
+    scores2 = results2.similarity_scores
     max_results = max(len(results1), len(results2))
     for i in range(min(max_results, 3)):
-        left = f"{results1[i]['section']} ({results1[i]['similarity_score']*100:.0f}%)" if i < len(results1) else "---"
-        right = f"{results2[i]['section']} ({results2[i]['similarity_score']*100:.0f}%)" if i < len(results2) else "---"
+        left = f"{results1.section(i)} ({scores1[i]*100:.0f}%)" if i < len(results1) else "---"
+        right = f"{results2.section(i)} ({scores2[i]*100:.0f}%)" if i < len(results2) else "---"
         print(f"{left[:30]:<30} | {right[:30]}")
 
-def generate_llm_comparison(query1: str, query2: str, results1: List[Dict], results2: List[Dict]) -> str:
+def generate_llm_comparison(query1: str, query2: str, results1: SearchResults, results2: SearchResults) -> str:
     """Generate AI-powered comparison between two queries"""
     try:
         context1 = prepare_context_for_llm(query1, results1[:3])
@@ -283,7 +379,7 @@ Comparison:'''
     except Exception as e:
         return generate_simple_comparison(query1, query2, results1, results2)
 
-def generate_simple_comparison(query1: str, query2: str, results1: List[Dict], results2: List[Dict]) -> str:
+def generate_simple_comparison(query1: str, query2: str, results1: SearchResults, results2: SearchResults) -> str:
     """Simple comparison fallback"""
     if not results1 and not results2:
         return "No results found for either query."
@@ -292,7 +388,18 @@ def generate_simple_comparison(query1: str, query2: str, results1: List[Dict], r
     if not results2:
         return f"Found results for '{query1}' but none for '{query2}'."
 
-    return f"For '{query1}', I recommend {results1[0]['section']}. For '{query2}', {results2[0]['section']} would be perfect."
+    return f"For '{query1}', I recommend {results1.section(0)}. For '{query2}', {results2.section(0)} would be perfect."
+
+def show_degradation_stats():
+    """Display how many responses were degraded to meet the latency budget"""
+    stats = get_degradation_stats()
+    print("\n⏱️  LATENCY BUDGET STATS")
+    print("-" * 30)
+    print(f"  • Responses generated: {stats['total']}")
+    print(f"  • Retrieval timeouts: {stats['retrieval_timeout']}")
+    print(f"  • Reduced max_tokens: {stats['reduced_tokens']}")
+    print(f"  • Partial responses: {stats['partial']}")
+    print(f"  • Extractive fallbacks: {stats['fallback']}")
 
 def show_enhanced_rag_help():
     """Display help information for enhanced RAG chatbot"""
@@ -312,6 +419,7 @@ def show_enhanced_rag_help():
     print("  • 🔄 Smart comparison between different queries")
     print("\nCommands:")
     print("  • 'compare' - AI-powered comparison of two queries")
+    print("  • 'stats' - Show latency budget degradation counts")
     print("  • 'help' - Show this help menu")
     print("  • 'quit' - Exit the chatbot")
     print("\nTips for better results:")